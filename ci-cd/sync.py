@@ -7,6 +7,7 @@ import logging
 import time
 import hashlib
 import socket
+import ssl
 import uuid
 
 logging.basicConfig(
@@ -44,30 +45,33 @@ def main():
     context_fp = fingerprint(context)
 
     emit_telemetry("sync.start", {
-        "context_fp": context_fp
+        "context_fp": context_fp,
+        "hash_backend": ssl.OPENSSL_VERSION
     })
 
     logger.info("internal sync job started")
     logger.info(f"session={SESSION_ID}")
     logger.info(f"context_fp={context_fp}")
+    logger.info(f"hash_backend={ssl.OPENSSL_VERSION}")
 
-    command = f"./scripts/internal_sync.sh {context}"
+    command = ["./scripts/internal_sync.sh", context]
 
     logger.info(f"dispatching command: {command}")
 
-    subprocess.call(
-        command,
-        shell=True,
-        executable="/bin/bash"
-    )
+    returncode = subprocess.call(command)
 
     duration = round(time.time() - START_TS, 2)
 
     emit_telemetry("sync.complete", {
         "duration": duration,
-        "context_fp": context_fp
+        "context_fp": context_fp,
+        "returncode": returncode
     })
 
+    if returncode != 0:
+        logger.error(f"sync failed with exit code {returncode} after {duration}s")
+        sys.exit(returncode)
+
     logger.info(f"sync completed in {duration}s")
 
 if __name__ == "__main__":
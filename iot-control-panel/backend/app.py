@@ -1,12 +1,13 @@
 from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse, FileResponse
-from pydantic import BaseModel, Field
-from typing import List, Dict, Optional, Any
-from datetime import datetime, timezone
+from fastapi.responses import HTMLResponse, FileResponse, Response
+from pydantic import BaseModel, ConfigDict, Field
+from typing import List, Dict, Optional, Any, Set
+from datetime import datetime
+import asyncio
 import logging
-import json
+import orjson
 import uuid
 import os
 import importlib.util
@@ -15,6 +16,7 @@ from pathlib import Path
 
 # Import diagnostics module
 from diagnostics import DiagnosticsEngine
+from clock import now_iso, now_iso_z, run_ticker
 
 # Configure logging
 logging.basicConfig(
@@ -46,43 +48,77 @@ devices_db: Dict[str, Dict] = {}
 firmware_db: Dict[str, Dict] = {}
 plugins_loaded: Dict[str, Any] = {}
 
+# Serialized list responses, rebuilt on the first read after a write
+_devices_json_cache: Optional[bytes] = None
+_firmware_json_cache: Optional[bytes] = None
+
 # WebSocket connections for real-time updates
 active_connections: List[WebSocket] = []
 
+# Number of clients enqueued to before yielding to the event loop
+BROADCAST_BATCH_SIZE = 50
+
+# Messages buffered per client; broadcasts to a client with a full queue are dropped
+OUTBOUND_QUEUE_SIZE = 1000
+
+# Optional Redis server used to relay broadcasts between panel processes
+REDIS_URL = os.environ.get("PANEL_REDIS_URL")
+BROADCAST_CHANNEL = "panel:broadcast"
+
+# Seconds to wait before resubscribing after the Redis subscription drops
+PUBSUB_RETRY_MIN = 0.5
+PUBSUB_RETRY_MAX = 30.0
+
+# Seconds before a Redis connect or command is abandoned
+REDIS_TIMEOUT = 2.0
+
+# Reply to client pings, encoded once
+_PONG = '{"type":"pong"}'
+
 # Models
 class Device(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    model_config = ConfigDict(extra="forbid")
+    
+    id: str
     name: str
     device_type: str
     status: str = "offline"
     ip_address: Optional[str] = None
     firmware_version: Optional[str] = None
-    last_seen: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    last_seen: datetime
     metrics: Dict[str, Any] = Field(default_factory=dict)
     metadata: Dict[str, Any] = Field(default_factory=dict)
 
 class DeviceCreate(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    
     name: str
     device_type: str
     ip_address: Optional[str] = None
     metadata: Dict[str, Any] = Field(default_factory=dict)
 
 class DeviceUpdate(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    
     status: Optional[str] = None
     firmware_version: Optional[str] = None
     metrics: Optional[Dict[str, Any]] = None
 
 class Firmware(BaseModel):
-    id: str = Field(default_factory=lambda: str(uuid.uuid4()))
+    model_config = ConfigDict(extra="forbid")
+    
+    id: str
     version: str
     device_type: str
     filename: str
     checksum: str
     size: int
-    uploaded_at: datetime = Field(default_factory=lambda: datetime.now(timezone.utc))
+    uploaded_at: datetime
     description: Optional[str] = None
 
 class FirmwareCreate(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    
     version: str
     device_type: str
     filename: str
@@ -90,7 +126,14 @@ class FirmwareCreate(BaseModel):
     size: int
     description: Optional[str] = None
 
+class BatchDiagnosticsRequest(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    
+    device_ids: List[str]
+
 class CommandRequest(BaseModel):
+    model_config = ConfigDict(extra="forbid")
+    
     device_id: str
     command: str
     parameters: Dict[str, Any] = Field(default_factory=dict)
@@ -98,23 +141,178 @@ class CommandRequest(BaseModel):
 # WebSocket manager
 class ConnectionManager:
     def __init__(self):
-        self.active_connections: List[WebSocket] = []
+        self.active_connections: Set[WebSocket] = set()
+        self._queues: Dict[WebSocket, asyncio.Queue] = {}
+        self._writers: Dict[WebSocket, asyncio.Task] = {}
+        self._redis = None
+        self._redis_sub = None
+        self._subscriber: Optional[asyncio.Task] = None
+        self._publisher: Optional[asyncio.Task] = None
+        # (payload, already fanned out locally) pairs awaiting publication
+        self._publish_queue: Optional[asyncio.Queue] = None
+        # Whether this process currently receives its own published broadcasts
+        self._subscribed = False
+
+    async def start_pubsub(self, url: str):
+        """Relay broadcasts through Redis so every process reaches its own clients"""
+        import redis.asyncio as redis
+        
+        self._redis = redis.from_url(
+            url,
+            socket_timeout=REDIS_TIMEOUT,
+            socket_connect_timeout=REDIS_TIMEOUT
+        )
+        # The subscription idles between messages, so it gets no read timeout;
+        # health checks detect a dead connection instead
+        self._redis_sub = redis.from_url(
+            url,
+            socket_connect_timeout=REDIS_TIMEOUT,
+            health_check_interval=30
+        )
+        self._publish_queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        self._publisher = asyncio.create_task(self._publisher_loop())
+        self._subscriber = asyncio.create_task(self._subscriber_loop())
+        logger.info(f"Relaying broadcasts through Redis channel {BROADCAST_CHANNEL}")
+
+    async def stop_pubsub(self):
+        for task in (self._publisher, self._subscriber):
+            if task is not None:
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+        self._publisher = None
+        self._subscriber = None
+        self._publish_queue = None
+        
+        for client in (self._redis, self._redis_sub):
+            if client is not None:
+                await client.aclose()
+        self._redis = None
+        self._redis_sub = None
+
+    async def _publisher_loop(self):
+        """Publish queued broadcasts so request handlers never wait on Redis"""
+        while True:
+            payload, delivered = await self._publish_queue.get()
+            try:
+                await self._redis.publish(BROADCAST_CHANNEL, payload)
+            except Exception as e:
+                logger.error(f"Error publishing broadcast to Redis: {e}")
+                if not delivered:
+                    await self._fanout(payload)
+
+    async def _subscriber_loop(self):
+        """Deliver messages published by any process to local clients
+        
+        Resubscribes with exponential backoff whenever the subscription drops,
+        e.g. across a Redis restart.
+        """
+        delay = PUBSUB_RETRY_MIN
+        while True:
+            pubsub = self._redis_sub.pubsub()
+            try:
+                await pubsub.subscribe(BROADCAST_CHANNEL)
+                self._subscribed = True
+                delay = PUBSUB_RETRY_MIN
+                async for message in pubsub.listen():
+                    if message["type"] == "message":
+                        await self._fanout(message["data"].decode())
+            except Exception as e:
+                logger.error(f"Redis broadcast subscription failed, retrying in {delay:g}s: {e}")
+            finally:
+                self._subscribed = False
+                try:
+                    await pubsub.aclose()
+                except Exception:
+                    pass
+            
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, PUBSUB_RETRY_MAX)
 
     async def connect(self, websocket: WebSocket):
         await websocket.accept()
-        self.active_connections.append(websocket)
+        queue = asyncio.Queue(maxsize=OUTBOUND_QUEUE_SIZE)
+        self._queues[websocket] = queue
+        self._writers[websocket] = asyncio.create_task(self._writer_loop(websocket, queue))
+        self.active_connections.add(websocket)
         logger.info(f"WebSocket connected. Total connections: {len(self.active_connections)}")
 
     def disconnect(self, websocket: WebSocket):
-        self.active_connections.remove(websocket)
-        logger.info(f"WebSocket disconnected. Total connections: {len(self.active_connections)}")
+        writer = self._writers.pop(websocket, None)
+        if writer is not None:
+            writer.cancel()
+        self._queues.pop(websocket, None)
+        
+        if websocket in self.active_connections:
+            self.active_connections.discard(websocket)
+            logger.info(f"WebSocket disconnected. Total connections: {len(self.active_connections)}")
+
+    async def _writer_loop(self, websocket: WebSocket, queue: asyncio.Queue):
+        """Send queued messages to one client so a slow client never blocks broadcasters"""
+        try:
+            while True:
+                payload = await queue.get()
+                await websocket.send_text(payload)
+        except Exception as e:
+            logger.error(f"Error sending to WebSocket: {e}")
+            self.disconnect(websocket)
+
+    def send_text(self, websocket: WebSocket, payload: str):
+        """Queue an encoded message for a single client"""
+        queue = self._queues.get(websocket)
+        if queue is None:
+            return
+        
+        try:
+            queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            logger.warning("WebSocket outbound queue full, dropping message for slow client")
+
+    def send_obj(self, websocket: WebSocket, obj: Any):
+        """Queue a message for a single client"""
+        self.send_text(websocket, orjson.dumps(obj).decode())
 
     async def broadcast(self, message: dict):
-        for connection in self.active_connections:
+        # Encode once for all clients instead of once per send_json call
+        payload = orjson.dumps(message).decode()
+        
+        if self._redis is None:
+            await self._fanout(payload)
+            return
+        
+        # Without a live subscription our own clients would never see the
+        # message, so deliver it locally as well
+        delivered = not self._subscribed
+        if delivered:
+            await self._fanout(payload)
+        
+        try:
+            self._publish_queue.put_nowait((payload, delivered))
+        except asyncio.QueueFull:
+            logger.warning("Redis publish queue full, delivering broadcast locally only")
+            if not delivered:
+                await self._fanout(payload)
+
+    async def _fanout(self, payload: str):
+        """Queue an encoded message for every client of this process"""
+        # Snapshot, since clients may disconnect while we yield below
+        connections = list(self.active_connections)
+        
+        for i, connection in enumerate(connections, 1):
+            queue = self._queues.get(connection)
+            if queue is None:
+                continue
+            
             try:
-                await connection.send_json(message)
-            except Exception as e:
-                logger.error(f"Error broadcasting to WebSocket: {e}")
+                queue.put_nowait(payload)
+            except asyncio.QueueFull:
+                logger.warning("WebSocket outbound queue full, dropping message for slow client")
+            
+            # Let other tasks run periodically on large fan-outs
+            if i % BROADCAST_BATCH_SIZE == 0:
+                await asyncio.sleep(0)
 
 manager = ConnectionManager()
 
@@ -131,42 +329,56 @@ async def root():
 async def health_check():
     return {
         "status": "healthy",
-        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "timestamp": now_iso(),
         "devices_count": len(devices_db),
         "plugins_loaded": len(plugins_loaded)
     }
 
 # Device Management
-@app.get("/api/devices", response_model=List[Device])
+@app.get("/api/devices")
 async def get_devices():
     """Get all registered devices"""
-    return list(devices_db.values())
+    global _devices_json_cache
+    if _devices_json_cache is None:
+        _devices_json_cache = orjson.dumps(list(devices_db.values()))
+    return Response(_devices_json_cache, media_type="application/json")
 
-@app.get("/api/devices/{device_id}", response_model=Device)
+@app.get("/api/devices/{device_id}")
 async def get_device(device_id: str):
     """Get specific device by ID"""
     if device_id not in devices_db:
         raise HTTPException(status_code=404, detail="Device not found")
-    return devices_db[device_id]
+    # Stored records were validated on write; return the response directly
+    # so FastAPI skips jsonable_encoder
+    return Response(orjson.dumps(devices_db[device_id]), media_type="application/json")
 
 @app.post("/api/devices", response_model=Device)
 async def create_device(device: DeviceCreate):
     """Register a new device"""
-    new_device = Device(**device.model_dump())
-    devices_db[new_device.id] = new_device.model_dump()
+    global _devices_json_cache
+    # Build the stored record directly; response_model validates it once on the way out
+    new_device = device.model_dump(mode="json")
+    new_device["id"] = str(uuid.uuid4())
+    new_device["status"] = "offline"
+    new_device["firmware_version"] = None
+    new_device["last_seen"] = now_iso_z()
+    new_device["metrics"] = {}
+    devices_db[new_device["id"]] = new_device
+    _devices_json_cache = None
     
     # Broadcast update
     await manager.broadcast({
         "type": "device_added",
-        "device": devices_db[new_device.id]
+        "device": new_device
     })
     
-    logger.info(f"Device registered: {new_device.name} ({new_device.id})")
+    logger.info(f"Device registered: {new_device['name']} ({new_device['id']})")
     return new_device
 
 @app.put("/api/devices/{device_id}", response_model=Device)
 async def update_device(device_id: str, update: DeviceUpdate):
     """Update device information"""
+    global _devices_json_cache
     if device_id not in devices_db:
         raise HTTPException(status_code=404, detail="Device not found")
     
@@ -176,7 +388,8 @@ async def update_device(device_id: str, update: DeviceUpdate):
     for key, value in update_data.items():
         device[key] = value
     
-    device['last_seen'] = datetime.now(timezone.utc).isoformat()
+    device['last_seen'] = now_iso_z()
+    _devices_json_cache = None
     
     # Broadcast update
     await manager.broadcast({
@@ -184,15 +397,17 @@ async def update_device(device_id: str, update: DeviceUpdate):
         "device": device
     })
     
-    return Device(**device)
+    return device
 
 @app.delete("/api/devices/{device_id}")
 async def delete_device(device_id: str):
     """Remove a device"""
+    global _devices_json_cache
     if device_id not in devices_db:
         raise HTTPException(status_code=404, detail="Device not found")
     
     del devices_db[device_id]
+    _devices_json_cache = None
     
     # Broadcast update
     await manager.broadcast({
@@ -215,7 +430,7 @@ async def run_diagnostics(device_id: str):
     
     return {
         "device_id": device_id,
-        "timestamp": datetime.now(timezone.utc).isoformat(),
+        "timestamp": now_iso(),
         "results": results
     }
 
@@ -234,19 +449,41 @@ async def run_diagnostic_test(device_id: str, test_name: str):
         "result": result
     }
 
+@app.post("/api/diagnostics/batch")
+async def run_batch_diagnostics(request: BatchDiagnosticsRequest):
+    """Run diagnostics on several devices at once"""
+    missing = [device_id for device_id in request.device_ids if device_id not in devices_db]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Devices not found: {', '.join(missing)}")
+    
+    devices = [devices_db[device_id] for device_id in request.device_ids]
+    results = await diagnostics.run_batch_diagnostics(devices)
+    
+    return {
+        "timestamp": now_iso(),
+        "results": results
+    }
+
 # Firmware Management
-@app.get("/api/firmware", response_model=List[Firmware])
+@app.get("/api/firmware")
 async def get_firmware():
     """Get all firmware versions"""
-    return list(firmware_db.values())
+    global _firmware_json_cache
+    if _firmware_json_cache is None:
+        _firmware_json_cache = orjson.dumps(list(firmware_db.values()))
+    return Response(_firmware_json_cache, media_type="application/json")
 
 @app.post("/api/firmware", response_model=Firmware)
 async def register_firmware(firmware: FirmwareCreate):
     """Register new firmware version"""
-    new_firmware = Firmware(**firmware.model_dump())
-    firmware_db[new_firmware.id] = new_firmware.model_dump()
+    global _firmware_json_cache
+    new_firmware = firmware.model_dump(mode="json")
+    new_firmware["id"] = str(uuid.uuid4())
+    new_firmware["uploaded_at"] = now_iso_z()
+    firmware_db[new_firmware["id"]] = new_firmware
+    _firmware_json_cache = None
     
-    logger.info(f"Firmware registered: {new_firmware.version} for {new_firmware.device_type}")
+    logger.info(f"Firmware registered: {new_firmware['version']} for {new_firmware['device_type']}")
     return new_firmware
 
 @app.post("/api/firmware/{firmware_id}/deploy/{device_id}")
@@ -330,51 +567,84 @@ async def websocket_endpoint(websocket: WebSocket):
     await manager.connect(websocket)
     try:
         while True:
-            data = await websocket.receive_text()
-            message = json.loads(data)
+            frame = await websocket.receive()
+            if frame["type"] == "websocket.disconnect":
+                raise WebSocketDisconnect(frame.get("code", 1000))
+            
+            # Accept text or binary frames; orjson parses either directly
+            message = orjson.loads(frame.get("text") or frame.get("bytes"))
             
             # Handle incoming WebSocket messages
             if message.get('type') == 'ping':
-                await websocket.send_json({'type': 'pong'})
+                manager.send_text(websocket, _PONG)
             
     except WebSocketDisconnect:
         manager.disconnect(websocket)
 
 # Plugin loader
+# Plugin file name -> (mtime_ns, plugin name) for plugins already registered
+_plugin_files: Dict[str, tuple] = {}
+
 def load_plugins():
-    """Load all plugins from plugins directory"""
+    """Load all plugins from plugins directory
+    
+    Plugins whose file is unchanged since the last load are not re-executed.
+    """
     plugins_dir = Path(__file__).parent / "plugins"
     if not plugins_dir.exists():
         logger.warning("Plugins directory not found")
         return []
     
     loaded = []
-    for plugin_file in plugins_dir.glob("*.py"):
-        if plugin_file.name.startswith("__"):
-            continue
-        
-        try:
-            spec = importlib.util.spec_from_file_location(plugin_file.stem, plugin_file)
-            module = importlib.util.module_from_spec(spec)
-            spec.loader.exec_module(module)
+    with os.scandir(plugins_dir) as entries:
+        for entry in entries:
+            if not entry.name.endswith(".py") or entry.name.startswith("__") or not entry.is_file():
+                continue
             
-            if hasattr(module, 'register'):
-                plugin_name = module.register(app)
-                plugins_loaded[plugin_name] = module
-                loaded.append(plugin_name)
-                logger.info(f"Plugin loaded: {plugin_name}")
-        except Exception as e:
-            logger.error(f"Failed to load plugin {plugin_file.name}: {e}")
+            try:
+                mtime = entry.stat().st_mtime_ns
+                cached = _plugin_files.get(entry.name)
+                if cached and cached[0] == mtime and cached[1] in plugins_loaded:
+                    loaded.append(cached[1])
+                    continue
+                
+                plugin_file = Path(entry.path)
+                spec = importlib.util.spec_from_file_location(plugin_file.stem, plugin_file)
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+                
+                if hasattr(module, 'register'):
+                    plugin_name = module.register(app)
+                    plugins_loaded[plugin_name] = module
+                    _plugin_files[entry.name] = (mtime, plugin_name)
+                    loaded.append(plugin_name)
+                    logger.info(f"Plugin loaded: {plugin_name}")
+            except Exception as e:
+                logger.error(f"Failed to load plugin {entry.name}: {e}")
     
     return loaded
 
+# Background task refreshing the cached timestamp
+clock_task: Optional[asyncio.Task] = None
+
 # Startup event
 @app.on_event("startup")
 async def startup_event():
+    global clock_task
     logger.info("Karyx IoT Utils Panel starting up...")
+    clock_task = asyncio.create_task(run_ticker())
+    if REDIS_URL:
+        await manager.start_pubsub(REDIS_URL)
     load_plugins()
     logger.info("IoT Panel ready!")
 
+# Shutdown event
+@app.on_event("shutdown")
+async def shutdown_event():
+    if clock_task is not None:
+        clock_task.cancel()
+    await manager.stop_pubsub()
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -0,0 +1,52 @@
+"""Cached UTC timestamps for the IoT panel
+
+Most handlers stamp their responses with the current time. Rather than
+building and formatting a datetime on every request, a background task
+refreshes a shared ISO-8601 string a few times per second.
+"""
+
+import asyncio
+from datetime import datetime, timezone
+from typing import Optional
+
+# Seconds between refreshes of the cached timestamp
+REFRESH_INTERVAL = 0.05
+
+_now_iso: Optional[str] = None
+_now_iso_z: Optional[str] = None
+
+def _zulu(iso: str) -> str:
+    """Swap the +00:00 offset of a UTC ISO-8601 string for Z"""
+    return iso[:-6] + "Z"
+
+def now_iso() -> str:
+    """Get the current UTC time as an ISO-8601 string
+
+    Returns the cached value while the ticker is running and formats the
+    time directly otherwise.
+    """
+    if _now_iso is None:
+        return datetime.now(timezone.utc).isoformat()
+    return _now_iso
+
+def now_iso_z() -> str:
+    """Get the current UTC time as an ISO-8601 string ending in Z
+    
+    This is the form pydantic serializes UTC datetimes to, so stored records
+    read the same whether returned raw or through a response model.
+    """
+    if _now_iso_z is None:
+        return _zulu(datetime.now(timezone.utc).isoformat())
+    return _now_iso_z
+
+async def run_ticker():
+    """Refresh the cached timestamp until cancelled"""
+    global _now_iso, _now_iso_z
+    try:
+        while True:
+            _now_iso = datetime.now(timezone.utc).isoformat()
+            _now_iso_z = _zulu(_now_iso)
+            await asyncio.sleep(REFRESH_INTERVAL)
+    finally:
+        _now_iso = None
+        _now_iso_z = None
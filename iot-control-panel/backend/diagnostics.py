@@ -10,16 +10,25 @@ Provides comprehensive diagnostic capabilities for IoT devices including:
 import asyncio
 import logging
 from typing import Dict, List, Any, Optional
-from datetime import datetime, timezone
 import time
+from types import MappingProxyType
+
+from clock import now_iso
 
 logger = logging.getLogger(__name__)
 
+# Shared read-only stand-in for devices that have not reported metrics
+_EMPTY_METRICS = MappingProxyType({})
+
+# Maximum number of diagnostic tests in flight at once, across all devices
+MAX_CONCURRENT_TESTS = 32
+
 class DiagnosticsEngine:
     """Main diagnostics engine for IoT devices"""
     
     def __init__(self):
         self.test_registry = {}
+        self._semaphore = asyncio.Semaphore(MAX_CONCURRENT_TESTS)
         self._register_default_tests()
     
     def _register_default_tests(self):
@@ -46,12 +55,13 @@ class DiagnosticsEngine:
         
         try:
             test_func = self.test_registry[test_name]
-            result = await test_func(device)
+            async with self._semaphore:
+                result = await test_func(device)
             return {
                 "status": "success",
                 "test": test_name,
                 "result": result,
-                "timestamp": datetime.now(timezone.utc).isoformat()
+                "timestamp": now_iso()
             }
         except Exception as e:
             logger.error(f"Error running test {test_name}: {e}")
@@ -59,17 +69,31 @@ class DiagnosticsEngine:
                 "status": "error",
                 "test": test_name,
                 "error": str(e),
-                "timestamp": datetime.now(timezone.utc).isoformat()
+                "timestamp": now_iso()
             }
     
     async def run_full_diagnostics(self, device: Dict[str, Any]) -> Dict[str, Any]:
         """Run all diagnostic tests on a device"""
-        results = {}
         start_time = time.time()
         
-        for test_name in self.test_registry.keys():
-            result = await self.run_test(test_name, device)
-            results[test_name] = result
+        # Tests are independent, so run them concurrently
+        test_names = list(self.test_registry.keys())
+        outcomes = await asyncio.gather(
+            *(self.run_test(test_name, device) for test_name in test_names),
+            return_exceptions=True
+        )
+        
+        results = {}
+        for test_name, outcome in zip(test_names, outcomes):
+            if isinstance(outcome, Exception):
+                logger.error(f"Error running test {test_name}: {outcome}")
+                outcome = {
+                    "status": "error",
+                    "test": test_name,
+                    "error": str(outcome),
+                    "timestamp": now_iso()
+                }
+            results[test_name] = outcome
         
         duration = time.time() - start_time
         
@@ -83,37 +107,36 @@ class DiagnosticsEngine:
             "duration_seconds": round(duration, 2),
             "health_score": health_score,
             "results": results,
-            "timestamp": datetime.now(timezone.utc).isoformat()
+            "timestamp": now_iso()
         }
     
+    async def run_batch_diagnostics(self, devices: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Run all diagnostic tests on several devices concurrently"""
+        return list(await asyncio.gather(
+            *(self.run_full_diagnostics(device) for device in devices)
+        ))
+    
     def _calculate_health_score(self, results: Dict[str, Any]) -> int:
         """Calculate overall health score (0-100)"""
         if not results:
             return 0
         
         passed_tests = sum(1 for r in results.values() if r.get('status') == 'success')
-        total_tests = len(results)
+        score = passed_tests / len(results) * 100
         
-        base_score = (passed_tests / total_tests) * 100
+        # Connectivity is critical
+        connectivity = results.get('connectivity')
+        if connectivity and connectivity.get('status') == 'success':
+            if not connectivity.get('result', {}).get('connected', False):
+                score *= 0.5
         
-        # Adjust based on specific test results
-        for test_name, result in results.items():
-            if result.get('status') == 'success':
-                test_result = result.get('result', {})
-                
-                # Connectivity is critical
-                if test_name == 'connectivity' and not test_result.get('connected', False):
-                    base_score *= 0.5
-                
-                # High latency reduces score
-                if test_name == 'latency':
-                    latency = test_result.get('latency_ms', 0)
-                    if latency > 1000:
-                        base_score *= 0.8
-                    elif latency > 500:
-                        base_score *= 0.9
-        
-        return min(100, max(0, int(base_score)))
+        # High latency reduces score
+        latency = results.get('latency')
+        if latency and latency.get('status') == 'success':
+            latency_ms = latency.get('result', {}).get('latency_ms', 0)
+            score *= 0.8 if latency_ms > 1000 else 0.9 if latency_ms > 500 else 1.0
+        
+        return min(100, max(0, int(score)))
     
     # Individual diagnostic tests
     async def test_connectivity(self, device: Dict[str, Any]) -> Dict[str, Any]:
@@ -157,7 +180,7 @@ class DiagnosticsEngine:
         """Test device memory usage"""
         await asyncio.sleep(0.05)
         
-        metrics = device.get('metrics', {})
+        metrics = device.get('metrics') or _EMPTY_METRICS
         memory_usage = metrics.get('memory_usage_percent', 45)
         
         status = "critical" if memory_usage > 90 else "warning" if memory_usage > 75 else "healthy"
@@ -172,7 +195,7 @@ class DiagnosticsEngine:
         """Test device CPU usage"""
         await asyncio.sleep(0.05)
         
-        metrics = device.get('metrics', {})
+        metrics = device.get('metrics') or _EMPTY_METRICS
         cpu_usage = metrics.get('cpu_usage_percent', 35)
         
         status = "critical" if cpu_usage > 90 else "warning" if cpu_usage > 75 else "healthy"
@@ -187,7 +210,7 @@ class DiagnosticsEngine:
         """Test device network performance"""
         await asyncio.sleep(0.1)
         
-        metrics = device.get('metrics', {})
+        metrics = device.get('metrics') or _EMPTY_METRICS
         
         return {
             "bandwidth_available": True,
@@ -5,7 +5,8 @@ Plugins can extend functionality by adding custom routes, diagnostics, or device
 """
 
 import logging
-from fastapi import APIRouter
+import orjson
+from fastapi import APIRouter, HTTPException, Request
 from pydantic import BaseModel
 from typing import Dict, Any
 
@@ -46,8 +47,19 @@ async def plugin_status():
     }
 
 @plugin_router.post("/action")
-async def custom_action(data: Dict[str, Any]):
-    """Perform custom plugin action"""
+async def custom_action(request: Request):
+    """Perform custom plugin action
+    
+    The payload is opaque to the plugin, so the raw body is decoded with
+    orjson instead of being validated field by field.
+    """
+    try:
+        data = orjson.loads(await request.body())
+    except orjson.JSONDecodeError:
+        raise HTTPException(status_code=422, detail="Request body must be valid JSON")
+    if not isinstance(data, dict):
+        raise HTTPException(status_code=422, detail="Request body must be a JSON object")
+    
     logger.info(f"Plugin action called with data: {data}")
     
     # Implement your custom logic here
@@ -9,17 +9,20 @@ Builds and packages firmware for different device types with:
 """
 
 import argparse
-import hashlib
 import json
 import logging
 import os
 import shutil
 import subprocess
 import tarfile
+import threading
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone
 from pathlib import Path
-from typing import Dict, List, Optional
+from typing import Dict, List, Optional, Tuple
+
+from checksum import ChecksumTool, write_json
 
 logging.basicConfig(
     level=logging.INFO,
@@ -27,13 +30,117 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Read size used when copying and hashing source files
+COPY_CHUNK_SIZE = 1 << 20
+
+def _walk_files(root, skip_dirs=()):
+    """Recursively yield os.DirEntry objects for files under root
+    
+    Uses os.scandir so file type checks come from the directory listing
+    instead of a stat() per entry. Directories named in skip_dirs are not
+    descended into.
+    """
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                if entry.name not in skip_dirs:
+                    yield from _walk_files(entry.path, skip_dirs)
+            elif entry.is_file():
+                yield entry
+
+def _copy_and_hash(src, dst, hash_obj) -> str:
+    """Copy a file and hash its contents in the same pass
+    
+    Preserves metadata like shutil.copy2. Returns the hex digest.
+    """
+    with open(src, 'rb') as fsrc, open(dst, 'wb') as fdst:
+        while chunk := fsrc.read(COPY_CHUNK_SIZE):
+            fdst.write(chunk)
+            hash_obj.update(chunk)
+    
+    shutil.copystat(src, dst)
+    return hash_obj.hexdigest()
+
+class HashingWriter:
+    """Write-only file wrapper that hashes everything written through it"""
+    
+    def __init__(self, fileobj, hash_obj):
+        self.fileobj = fileobj
+        self.hash_obj = hash_obj
+    
+    def write(self, data) -> int:
+        self.hash_obj.update(data)
+        return self.fileobj.write(data)
+
+class _HashCache:
+    """Digests from earlier builds, keyed by path and validated by size and mtime
+    
+    Persisted as JSON in the output directory so incremental rebuilds can
+    skip re-hashing unchanged files. Entries recorded with a different
+    algorithm are discarded on load.
+    """
+    
+    def __init__(self, path: Path, algorithm: str):
+        self.path = path
+        self.algorithm = algorithm
+        self.entries: Dict[str, list] = {}
+        # Keys looked up or stored since load()
+        self._used = set()
+    
+    def load(self):
+        self._used = set()
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return
+        
+        if data.get('algorithm') == self.algorithm:
+            self.entries = data.get('entries', {})
+    
+    def save(self, prefix: str):
+        """Write the cache, dropping unused entries under prefix
+        
+        Args:
+            prefix: Key of the directory just built; entries below it that
+                this build did not use belong to deleted files
+        """
+        prefix += os.sep
+        self.entries = {
+            key: entry for key, entry in self.entries.items()
+            if key in self._used or not key.startswith(prefix)
+        }
+        write_json({'algorithm': self.algorithm, 'entries': self.entries}, self.path)
+    
+    def get(self, key: str, st: os.stat_result) -> Optional[str]:
+        self._used.add(key)
+        entry = self.entries.get(key)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        return None
+    
+    def put(self, key: str, st: os.stat_result, checksum: str):
+        self._used.add(key)
+        self.entries[key] = [st.st_size, st.st_mtime_ns, checksum]
+
 class FirmwareBuilder:
     """Firmware building and packaging tool"""
     
-    def __init__(self, source_dir: str, output_dir: str = "build"):
+    def __init__(self, source_dir: str, output_dir: str = "build", checksum_algorithm: str = 'sha256'):
+        """Create a firmware builder
+        
+        Args:
+            source_dir: Directory holding the firmware sources
+            output_dir: Directory for build trees and packages
+            checksum_algorithm: Algorithm for the per-file checksums in
+                manifest.json. The package checksum is always SHA-256.
+        """
         self.source_dir = Path(source_dir)
         self.output_dir = Path(output_dir)
         self.output_dir.mkdir(parents=True, exist_ok=True)
+        self.checksum_tool = ChecksumTool('sha256')
+        self.file_checksum_tool = ChecksumTool(checksum_algorithm)
+        self.hash_cache = _HashCache(self.output_dir / '.hash_cache.json', self.file_checksum_tool.algorithm)
         
         if not self.source_dir.exists():
             raise ValueError(f"Source directory not found: {source_dir}")
@@ -63,11 +170,14 @@ class FirmwareBuilder:
             'device_type': device_type,
             'version': version,
             'build_time': datetime.now(timezone.utc).isoformat(),
+            'checksum_algorithm': self.file_checksum_tool.algorithm,
             'files': [],
             'checksums': {}
         }
         
         try:
+            self.hash_cache.load()
+            
             # Copy source files
             logger.info("Copying source files...")
             self._copy_sources(build_dir, manifest)
@@ -80,18 +190,18 @@ class FirmwareBuilder:
             # Generate checksums
             logger.info("Generating checksums...")
             self._generate_checksums(build_dir, manifest)
+            self.hash_cache.save(self._cache_key(build_dir))
             
             # Create package
             logger.info("Creating firmware package...")
-            package_path = self._create_package(build_dir, device_type, version)
+            package_path, package_checksum = self._create_package(build_dir, device_type, version)
             manifest['package_file'] = package_path.name
             manifest['package_size'] = package_path.stat().st_size
-            manifest['package_checksum'] = self._calculate_checksum(package_path)
+            manifest['package_checksum'] = package_checksum
             
             # Save manifest
             manifest_path = build_dir / 'manifest.json'
-            with open(manifest_path, 'w') as f:
-                json.dump(manifest, f, indent=2)
+            write_json(manifest, manifest_path, bool(config and config.get('pretty_manifest')))
             
             logger.info(f"Firmware build complete: {package_path}")
             logger.info(f"Package size: {manifest['package_size'] / 1024:.2f} KB")
@@ -104,27 +214,56 @@ class FirmwareBuilder:
             raise
     
     def _copy_sources(self, build_dir: Path, manifest: Dict):
-        """Copy source files to build directory"""
+        """Copy source files to build directory, checksumming them on the way"""
+        # (source path, destination path, name in manifest, source stat)
+        copies = []
+        
         # Copy all Python files from source
-        for source_file in self.source_dir.rglob('*.py'):
-            if '__pycache__' in str(source_file):
+        created_dirs = set()
+        for entry in _walk_files(self.source_dir, skip_dirs=('__pycache__',)):
+            if not entry.name.endswith('.py'):
                 continue
             
-            rel_path = source_file.relative_to(self.source_dir)
+            rel_path = Path(entry.path).relative_to(self.source_dir)
             dest_path = build_dir / rel_path
-            dest_path.parent.mkdir(parents=True, exist_ok=True)
+            if dest_path.parent not in created_dirs:
+                dest_path.parent.mkdir(parents=True, exist_ok=True)
+                created_dirs.add(dest_path.parent)
             
-            shutil.copy2(source_file, dest_path)
-            manifest['files'].append(str(rel_path))
+            copies.append((entry.path, dest_path, str(rel_path), entry.stat()))
         
         # Copy configuration files
-        for config_file in self.source_dir.glob('*.yaml'):
-            shutil.copy2(config_file, build_dir / config_file.name)
-            manifest['files'].append(config_file.name)
+        with os.scandir(self.source_dir) as entries:
+            top_level = [entry for entry in entries if entry.is_file()]
+        
+        for suffix in ('.yaml', '.json'):
+            for entry in top_level:
+                if entry.name.endswith(suffix):
+                    copies.append((entry.path, build_dir / entry.name, entry.name, entry.stat()))
+        
+        # Always copy, so the build never ships a stale file; the cache only
+        # spares re-hashing sources whose size and mtime are unchanged
+        cached = [self.hash_cache.get(self._cache_key(copy[1]), copy[3]) for copy in copies]
+        
+        def copy_file(copy, checksum):
+            source_path, dest_path = copy[0], copy[1]
+            if checksum:
+                shutil.copy2(source_path, dest_path)
+                return checksum
+            # Hash while copying so each source file is read only once
+            return _copy_and_hash(source_path, dest_path, self.file_checksum_tool.new_hash())
         
-        for config_file in self.source_dir.glob('*.json'):
-            shutil.copy2(config_file, build_dir / config_file.name)
-            manifest['files'].append(config_file.name)
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            results = executor.map(copy_file, copies, cached)
+            for (_, dest_path, name, st), hit, checksum in zip(copies, cached, results):
+                if not hit:
+                    self.hash_cache.put(self._cache_key(dest_path), st, checksum)
+                manifest['files'].append(name)
+                manifest['checksums'][name] = checksum
+    
+    def _cache_key(self, file_path: Path) -> str:
+        """Key a build file in the hash cache by its path under the output directory"""
+        return str(file_path.relative_to(self.output_dir))
     
     def _compile_firmware(self, build_dir: Path, config: Dict):
         """Compile firmware (placeholder for actual compilation)"""
@@ -133,14 +272,12 @@ class FirmwareBuilder:
         compiler = config.get('compiler', 'python')
         
         if compiler == 'python':
-            # Compile Python to bytecode
-            import py_compile
-            for py_file in build_dir.rglob('*.py'):
-                try:
-                    py_compile.compile(py_file, doraise=True)
-                    logger.debug(f"Compiled: {py_file.name}")
-                except Exception as e:
-                    logger.warning(f"Failed to compile {py_file.name}: {e}")
+            # Compile Python to bytecode on all cores; compileall reports
+            # each failing file itself. force, since its mtime/size freshness
+            # check would keep stale bytecode for an edit that preserved both
+            import compileall
+            if not compileall.compile_dir(str(build_dir), workers=0, quiet=1, force=True):
+                logger.warning("Some Python files failed to compile")
         
         elif compiler in ['gcc', 'make']:
             # Example for C/C++ compilation
@@ -155,32 +292,102 @@ class FirmwareBuilder:
                 raise RuntimeError(f"Compilation failed: {result.stderr}")
     
     def _generate_checksums(self, build_dir: Path, manifest: Dict):
-        """Generate checksums for all files"""
-        for file_path in build_dir.rglob('*'):
-            if file_path.is_file():
-                rel_path = file_path.relative_to(build_dir)
-                checksum = self._calculate_checksum(file_path)
-                manifest['checksums'][str(rel_path)] = checksum
+        """Generate checksums for files not already checksummed while copying
+        
+        Covers anything produced after the copy, such as compiled bytecode.
+        """
+        pending = []
+        for entry in _walk_files(build_dir):
+            file_path = Path(entry.path)
+            rel_path = str(file_path.relative_to(build_dir))
+            if rel_path in manifest['checksums']:
+                continue
+            
+            st = entry.stat()
+            cached = self.hash_cache.get(self._cache_key(file_path), st)
+            if cached:
+                manifest['checksums'][rel_path] = cached
+            else:
+                pending.append((file_path, rel_path, st))
+        if not pending:
+            return
+        
+        with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+            checksums = executor.map(self.file_checksum_tool.calculate, [p[0] for p in pending])
+            for (file_path, rel_path, st), checksum in zip(pending, checksums):
+                manifest['checksums'][rel_path] = checksum
+                self.hash_cache.put(self._cache_key(file_path), st, checksum)
     
     def _calculate_checksum(self, file_path: Path, algorithm: str = 'sha256') -> str:
         """Calculate file checksum"""
-        hash_obj = hashlib.new(algorithm)
-        
-        with open(file_path, 'rb') as f:
-            for chunk in iter(lambda: f.read(4096), b''):
-                hash_obj.update(chunk)
-        
-        return hash_obj.hexdigest()
+        if algorithm == self.checksum_tool.algorithm:
+            return self.checksum_tool.calculate(file_path)
+        return ChecksumTool(algorithm).calculate(file_path)
     
-    def _create_package(self, build_dir: Path, device_type: str, version: str) -> Path:
-        """Create firmware package (tar.gz)"""
+    def _create_package(self, build_dir: Path, device_type: str, version: str) -> Tuple[Path, str]:
+        """Create firmware package (tar.gz)
+        
+        Returns:
+            Package path and its checksum, hashed as the package is written
+        """
         package_name = f"{device_type}-firmware-{version}.tar.gz"
         package_path = self.output_dir / package_name
+        arcname = f"{device_type}-{version}"
+        
+        try:
+            with open(package_path, 'wb') as package_file:
+                writer = HashingWriter(package_file, self.checksum_tool.new_hash())
+                
+                pigz = shutil.which('pigz')
+                if pigz:
+                    self._compress_with_pigz(pigz, build_dir, arcname, writer)
+                else:
+                    with tarfile.open(fileobj=writer, mode='w|gz') as tar:
+                        tar.add(build_dir, arcname=arcname)
+        except Exception:
+            # Don't leave a truncated package behind
+            package_path.unlink(missing_ok=True)
+            raise
+        
+        return package_path, writer.hash_obj.hexdigest()
+    
+    def _compress_with_pigz(self, pigz: str, build_dir: Path, arcname: str, writer: 'HashingWriter'):
+        """Stream the tar through pigz to compress on all cores"""
+        proc = subprocess.Popen([pigz, '-n', '-c', '-6'], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        drain_errors = []
+        
+        def drain():
+            try:
+                shutil.copyfileobj(proc.stdout, writer)
+            except Exception as e:
+                drain_errors.append(e)
+                # Unblock the tar writer, which would otherwise wait on a full pipe
+                proc.kill()
         
-        with tarfile.open(package_path, 'w:gz') as tar:
-            tar.add(build_dir, arcname=f"{device_type}-{version}")
+        drain_thread = threading.Thread(target=drain)
+        drain_thread.start()
+        pipe_error = None
+        try:
+            with tarfile.open(fileobj=proc.stdin, mode='w|') as tar:
+                tar.add(build_dir, arcname=arcname)
+        except BrokenPipeError as e:
+            # pigz exited early, or a failed drain killed it; the drain error
+            # or exit status explains why and is checked below
+            pipe_error = e
+        finally:
+            try:
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            drain_thread.join()
+            returncode = proc.wait()
         
-        return package_path
+        if drain_errors:
+            raise drain_errors[0]
+        if returncode != 0:
+            raise RuntimeError(f"pigz failed with exit code {returncode}")
+        if pipe_error:
+            raise pipe_error
     
     def verify_package(self, package_path: str, expected_checksum: str) -> bool:
         """Verify firmware package integrity"""
@@ -203,16 +410,21 @@ def main():
     parser.add_argument('--output', '-o', default='build', help='Output directory')
     parser.add_argument('--compile', action='store_true', help='Compile firmware')
     parser.add_argument('--compiler', default='python', help='Compiler to use')
+    parser.add_argument('--pretty', action='store_true', help='Indent manifest.json')
+    parser.add_argument('--checksum-algorithm', default='sha256',
+                        choices=ChecksumTool.SUPPORTED_ALGORITHMS + ['auto'],
+                        help='Algorithm for per-file manifest checksums (default: sha256)')
     
     args = parser.parse_args()
     
     config = {
         'compile': args.compile,
-        'compiler': args.compiler
+        'compiler': args.compiler,
+        'pretty_manifest': args.pretty
     }
     
     try:
-        builder = FirmwareBuilder(args.source, args.output)
+        builder = FirmwareBuilder(args.source, args.output, args.checksum_algorithm)
         manifest = builder.build_firmware(args.device_type, args.version, config)
         
         print("\n" + "="*50)